@@ -1,30 +1,26 @@
 import streamlit as st
 import os
-import io
-import pandas as pd
+import multiprocessing
 import requests
-import re
-import unicodedata
 import base64
 import time
 import boto3
 import json
 from botocore.exceptions import ClientError
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from requests.adapters import HTTPAdapter
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
-# =========================
-# AWS DynamoDB Setup
-# =========================
-dynamodb = boto3.resource("dynamodb", region_name="eu-west-2")
-table = dynamodb.Table("allowed_columns")
+from processing import filter_to_xlsx, norm, normalize_columns
 
 # =========================
-# Page config
+# AWS DynamoDB Setup
 # =========================
-st.set_page_config(
-    page_title="Excel to WhatsApp",
-    page_icon="📊",
-    layout="centered"
-)
+@st.cache_resource
+def get_table():
+    dynamodb = boto3.resource("dynamodb", region_name="eu-west-2")
+    return dynamodb.Table("allowed_columns")
 
 # =========================
 # Environment variables
@@ -49,113 +45,136 @@ def load_senders():
     return senders
 
 
-WASENDER_SENDERS = load_senders()
-
-if not WASENDER_SENDERS:
-    st.error("❌ No WhatsApp senders loaded from environment variables.")
-    st.stop()
-    
 # =========================
 # Helpers
 # =========================
-def norm(s: str) -> str:
-    s = unicodedata.normalize("NFKC", str(s or "")).strip()
-
-    # Exclude columns starting with special chars
-    if not re.match(r"^[A-Za-z0-9]", s):
-        return ""
-
-    s = s.replace("\u00a0", " ")
-    s = s.lower()
-    s = re.sub(r"[\s._\-]+", " ", s)
-    s = re.sub(r"[^a-z0-9 ]+", "", s)
-    s = re.sub(r"\s+", " ", s)
-    return s
+@st.cache_data(ttl=60, show_spinner=False)
+def fetch_allowed_columns() -> list[str]:
+    # Streamlit reruns the whole script on every interaction; this keeps
+    # the DynamoDB round trip off that path. Errors are not cached.
+    resp = get_table().get_item(Key={"type": "columns"})
+    return resp.get("Item", {}).get("values", [])
 
 
 def load_allowed_columns():
     try:
-        resp = table.get_item(Key={"type": "columns"})
-        return resp.get("Item", {}).get("values", [])
+        return fetch_allowed_columns()
     except ClientError as e:
         st.error(f"DynamoDB read failed: {e}")
         return []
 
 
 def save_allowed_columns(cols: list[str]):
-    table.put_item(
+    get_table().put_item(
         Item={
             "type": "columns",
             "values": sorted(set(cols))
         }
     )
+    fetch_allowed_columns.clear()
+
+
+def load_wanted_norm() -> frozenset[str]:
+    return normalize_columns(tuple(load_allowed_columns()))
 
 # =========================
 # Excel Processing
 # =========================
-def process_excel(file_bytes: bytes, wanted_norm: list[str], file_ext: str) -> pd.DataFrame:
-    bio = io.BytesIO(file_bytes)
-
-    if file_ext == "csv":
-        df = pd.read_csv(bio, dtype=str, header=None)
-    else:
-        engine = "xlrd" if file_ext == "xls" else "openpyxl"
-        df = pd.read_excel(bio, dtype=str, engine=engine, header=None)
-
-    df = df.fillna("")
+# Each parse worker re-imports this script (~150 MB), so the count is kept
+# small and fixed rather than scaled to the host's CPUs
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", "2"))
 
-    best_idx = -1
-    best_score = -1
 
-    for i in range(min(300, len(df))):
-        vals = [str(v) for v in df.iloc[i].tolist()]
-        score = sum(1 for v in vals if norm(v) in wanted_norm)
-        if score > best_score:
-            best_idx, best_score = i, score
+def new_process_pool(max_jobs: int) -> ProcessPoolExecutor:
+    # Parsing holds the GIL, so files are parsed in worker processes.
+    # Spawned workers start from a fresh interpreter instead of forking
+    # this multi-threaded server, and are only started as files come in.
+    # They import this script as __mp_main__, where main() does not run.
+    ctx = multiprocessing.get_context("spawn")
+    return ProcessPoolExecutor(max_workers=max(1, min(PARSE_WORKERS, max_jobs)), mp_context=ctx)
 
-    if best_idx < 0:
-        raise ValueError("Could not find header row matching allow-list")
 
-    header_vals = [str(v) for v in df.iloc[best_idx].tolist()]
-    body = df.iloc[best_idx + 1 :].reset_index(drop=True)
-    body.columns = header_vals
-
-    nm = {c: norm(c) for c in body.columns}
-    keep = [c for c in body.columns if nm[c] in wanted_norm]
+def run_in_process_pool(pool: ProcessPoolExecutor, fn, *args):
+    try:
+        return pool.submit(fn, *args).result()
+    except BrokenProcessPool:
+        # A worker died (e.g. OOM-killed); retry once in a fresh process
+        with new_process_pool(1) as retry_pool:
+            return retry_pool.submit(fn, *args).result()
 
-    if not keep:
-        raise ValueError("No matching columns found")
 
-    return body[keep]
+@st.cache_data(show_spinner=False, max_entries=16)
+def build_output(
+    _pool: ProcessPoolExecutor, file_bytes: bytes, wanted_norm: tuple[str, ...], file_ext: str
+) -> bytes:
+    # Cached on the upload bytes, so re-sending the same file skips the
+    # parse and the xlsx write entirely. The pool is left out of the key.
+    return run_in_process_pool(_pool, filter_to_xlsx, file_bytes, wanted_norm, file_ext)
 
 # =========================
 # WhatsApp Sender
 # =========================
-def send_to_whatsapp(file_bytes: bytes, filename: str, sender: dict) -> dict:
-    base64_data = base64.b64encode(file_bytes).decode("utf-8")
-    mime_type = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-    data_url = f"data:{mime_type};base64,{base64_data}"
+# Minimum gap between two sent messages, WasenderAPI rate-limits bursts
+SEND_INTERVAL = 7
 
-    headers = {
+
+@st.cache_resource
+def get_http_session() -> requests.Session:
+    # Shared across reruns so repeated sends reuse the same TLS connection
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+    return session
+
+
+class BodyParts:
+    # Request body sent as several byte strings without joining them first.
+    # Having a length keeps requests on Content-Length instead of chunked.
+    def __init__(self, *parts: bytes):
+        self.parts = parts
+
+    def __len__(self) -> int:
+        return sum(len(p) for p in self.parts)
+
+    def __iter__(self):
+        return iter(self.parts)
+
+
+def wasender_headers(sender: dict) -> dict:
+    return {
         "Authorization": f"Bearer {sender['api_key']}",
         "Content-Type": "application/json",
     }
 
-    upload_response = requests.post(
+
+def upload_to_wasender(file_bytes: bytes, sender: dict) -> str:
+    mime_type = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+    # The upload endpoint only takes a base64 data URL in a JSON body.
+    # Base64 output never needs JSON escaping, so the envelope is written
+    # around the encoded bytes rather than copied through str/json.dumps.
+    upload_body = BodyParts(
+        f'{{"base64": "data:{mime_type};base64,'.encode(),
+        base64.b64encode(file_bytes),
+        b'"}',
+    )
+
+    upload_response = get_http_session().post(
         "https://www.wasenderapi.com/api/upload",
-        headers=headers,
-        json={"base64": data_url},
+        headers=wasender_headers(sender),
+        data=upload_body,
         timeout=60,
     )
 
     if upload_response.status_code >= 300:
         raise Exception(f"Upload failed: {upload_response.text}")
 
-    temp_url = upload_response.json().get("publicUrl")
+    return upload_response.json().get("publicUrl")
+
 
-    send_response = requests.post(
+def send_document(temp_url: str, filename: str, sender: dict) -> dict:
+    send_response = get_http_session().post(
         "https://www.wasenderapi.com/api/send-message",
-        headers=headers,
+        headers=wasender_headers(sender),
         json={
             "sessionId": sender["session_id"],
             "to": sender["wa_to"],
@@ -171,133 +190,202 @@ def send_to_whatsapp(file_bytes: bytes, filename: str, sender: dict) -> dict:
     return send_response.json()
 
 
+def prepare_upload(
+    parse_pool: ProcessPoolExecutor, file_bytes: bytes, wanted_norm: tuple[str, ...], file_ext: str, sender: dict
+) -> str:
+    # Uploads are not messages, so they run ahead of the rate-limited sends
+    return upload_to_wasender(build_output(parse_pool, file_bytes, wanted_norm, file_ext), sender)
+
+
 # =========================
-# UI
+# App
 # =========================
-st.title("📊 Excel to WhatsApp")
-st.markdown("Upload Excel files and send filtered data to WhatsApp.")
-
-# 🔧 INIT SESSION STATE (IMPORTANT)
-if "column_added_msg" not in st.session_state:
-    st.session_state.column_added_msg = None
-    
-# -------- Permanent Column Input --------
-st.markdown("### ➕ Add Column (Permanent)")
-
-new_col = st.text_input(
-    "Enter column name to permanently allow",
-    placeholder="e.g. REMARKS, CATEGORY, DATE"
-)
-
-if st.button("Add Column Permanently"):
-    if not new_col.strip():
-        st.warning("Column name cannot be empty")
-    else:
-        cols = load_allowed_columns()
-
-        # ✅ SUPPORT COMMA-SEPARATED INPUT
-        input_cols = [c.strip() for c in new_col.split(",") if c.strip()]
-        existing_norms = [norm(c) for c in cols]
-
-        added = []
-        for col in input_cols:
-            if norm(col) not in existing_norms:
-                cols.append(col)
-                added.append(col)
-
-        if not added:
-            st.warning("All columns already exist")
+# The page only renders when Streamlit runs this file as __main__. Process
+# pool workers import it as __mp_main__ and must not run the UI.
+def main():
+    # =========================
+    # Page config
+    # =========================
+    st.set_page_config(
+        page_title="Excel to WhatsApp",
+        page_icon="📊",
+        layout="centered"
+    )
+
+    WASENDER_SENDERS = load_senders()
+
+    if not WASENDER_SENDERS:
+        st.error("❌ No WhatsApp senders loaded from environment variables.")
+        st.stop()
+
+    # =========================
+    # UI
+    # =========================
+    st.title("📊 Excel to WhatsApp")
+    st.markdown("Upload Excel files and send filtered data to WhatsApp.")
+
+    # 🔧 INIT SESSION STATE (IMPORTANT)
+    if "column_added_msg" not in st.session_state:
+        st.session_state.column_added_msg = None
+
+    # -------- Permanent Column Input --------
+    st.markdown("### ➕ Add Column (Permanent)")
+
+    new_col = st.text_input(
+        "Enter column name to permanently allow",
+        placeholder="e.g. REMARKS, CATEGORY, DATE"
+    )
+
+    if st.button("Add Column Permanently"):
+        if not new_col.strip():
+            st.warning("Column name cannot be empty")
         else:
-            save_allowed_columns(cols)
-            st.session_state.column_added_msg = (
-                f"✅ Added columns: {', '.join(added)}"
-            )
-            st.rerun()
-            
-if st.session_state.column_added_msg:
-    st.success(st.session_state.column_added_msg)
-
-# -------- Load Columns --------
-DB_COLS = load_allowed_columns()
-if not DB_COLS:
-    st.warning("⚠️ No allowed columns found in database")
-
-WANTED_NORM = [norm(c) for c in DB_COLS]
-
-st.markdown("### 📱 Select WhatsApp Sender")
-
-if not WASENDER_SENDERS:
-    st.error("❌ No WhatsApp senders configured. Please contact admin.")
-    st.stop()
-
-labels = [s["label"] for s in WASENDER_SENDERS]
-
-selected_label = st.selectbox(
-    "Send files from",
-    labels
-)
-
-selected_sender = next(
-    (s for s in WASENDER_SENDERS if s["label"] == selected_label),
-    None
-)
-
-if not selected_sender:
-    st.error("❌ Selected sender not found. Please contact admin.")
-    st.stop()
-
-
-# -------- File Upload --------
-uploaded_files = st.file_uploader(
-    "Select Excel Files",
-    type=["xlsx", "xls", "csv"],
-    accept_multiple_files=True
-)
-
-rename_map = {}
-
-if uploaded_files:
-    st.write("### Rename files (optional)")
-    for file in uploaded_files:
-        rename_map[file.name] = st.text_input(
-            f"Rename for {file.name}",
-            value=file.name.rsplit(".", 1)[0],
-            key=file.name
-        )
-
-# -------- Send Button --------
-if st.button("📤 Upload & Send to WhatsApp", type="primary", use_container_width=True):
-    if not uploaded_files:
-        st.error("⚠️ Please select at least one file")
-    else:
-        try:
-            for uploaded_file in uploaded_files:
-                file_bytes = uploaded_file.read()
-                file_ext = uploaded_file.name.rsplit(".", 1)[-1].lower()
-
-                filtered_df = process_excel(file_bytes, WANTED_NORM, file_ext)
-
-                output = io.BytesIO()
-                filtered_df.to_excel(output, index=False, engine="openpyxl")
-                processed_bytes = output.getvalue()
-
-                base_name = rename_map.get(uploaded_file.name, uploaded_file.name)
-                final_filename = base_name + ".xlsx"
-
-                with st.spinner(f"Sending {final_filename}..."):
-                    send_to_whatsapp(
-                                processed_bytes,
-                                final_filename,
-                                selected_sender
-                            )
-
-                st.success(
-                f"✅ Sent: {final_filename} → {selected_sender['label']}"
+            # Read past the cache: the list is written back whole, so a
+            # stale copy would drop columns saved since it was cached
+            fetch_allowed_columns.clear()
+            cols = load_allowed_columns()
+
+            # ✅ SUPPORT COMMA-SEPARATED INPUT
+            input_cols = [c.strip() for c in new_col.split(",") if c.strip()]
+            existing_norms = [norm(c) for c in cols]
+
+            added = []
+            for col in input_cols:
+                if norm(col) not in existing_norms:
+                    cols.append(col)
+                    added.append(col)
+
+            if not added:
+                st.warning("All columns already exist")
+            else:
+                save_allowed_columns(cols)
+                st.session_state.column_added_msg = (
+                    f"✅ Added columns: {', '.join(added)}"
                 )
-                time.sleep(7)
+                st.rerun()
+
+    if st.session_state.column_added_msg:
+        st.success(st.session_state.column_added_msg)
+
+    # -------- Load Columns --------
+    WANTED_NORM = load_wanted_norm()
+    if not WANTED_NORM:
+        st.warning("⚠️ No allowed columns found in database")
+
+    st.markdown("### 📱 Select WhatsApp Sender")
 
-        except Exception as e:
-            st.error(f"❌ Error: {str(e)}")
+    if not WASENDER_SENDERS:
+        st.error("❌ No WhatsApp senders configured. Please contact admin.")
+        st.stop()
 
-st.markdown("---")
-st.markdown("Built with Streamlit • Powered by WasenderAPI")
+    labels = [s["label"] for s in WASENDER_SENDERS]
+
+    selected_label = st.selectbox(
+        "Send files from",
+        labels
+    )
+
+    selected_sender = next(
+        (s for s in WASENDER_SENDERS if s["label"] == selected_label),
+        None
+    )
+
+    if not selected_sender:
+        st.error("❌ Selected sender not found. Please contact admin.")
+        st.stop()
+
+
+    # -------- File Upload --------
+    uploaded_files = st.file_uploader(
+        "Select Excel Files",
+        type=["xlsx", "xls", "csv"],
+        accept_multiple_files=True
+    )
+
+    rename_map = {}
+
+    if uploaded_files:
+        st.write("### Rename files (optional)")
+        for file in uploaded_files:
+            rename_map[file.name] = st.text_input(
+                f"Rename for {file.name}",
+                value=file.name.rsplit(".", 1)[0],
+                key=file.name
+            )
+
+    # -------- Send Button --------
+    if st.button("📤 Upload & Send to WhatsApp", type="primary", use_container_width=True):
+        if not uploaded_files:
+            st.error("⚠️ Please select at least one file")
+        else:
+            pool = None
+            parse_pool = None
+            current_file = None
+            try:
+                jobs = []
+                for uploaded_file in uploaded_files:
+                    current_file = uploaded_file.name
+                    file_bytes = uploaded_file.read()
+                    file_ext = uploaded_file.name.rsplit(".", 1)[-1].lower()
+                    jobs.append((uploaded_file.name, file_bytes, file_ext))
+
+                wanted_key = tuple(sorted(WANTED_NORM))
+
+                # Files are parsed and uploaded in parallel ahead of the send
+                # loop; UI updates stay on the script thread. The workers get
+                # this run's script context for the cached helpers they call.
+                # Parse workers only live for this click, so their memory is
+                # handed back once the files are sent.
+                parse_pool = new_process_pool(len(jobs))
+                pool = ThreadPoolExecutor(
+                    max_workers=min(4, len(jobs)),
+                    initializer=add_script_run_ctx,
+                    initargs=(None, get_script_run_ctx()),
+                )
+                futures = [
+                    pool.submit(prepare_upload, parse_pool, file_bytes, wanted_key, file_ext, selected_sender)
+                    for _, file_bytes, file_ext in jobs
+                ]
+
+                last_sent = None
+                for (name, _, _), future in zip(jobs, futures):
+                    current_file = name
+                    base_name = rename_map.get(name, name)
+                    final_filename = base_name + ".xlsx"
+
+                    with st.spinner(f"Sending {final_filename}..."):
+                        temp_url = future.result()
+
+                        if last_sent is not None:
+                            wait = SEND_INTERVAL - (time.monotonic() - last_sent)
+                            if wait > 0:
+                                time.sleep(wait)
+
+                        send_document(
+                                    temp_url,
+                                    final_filename,
+                                    selected_sender
+                                )
+                    last_sent = time.monotonic()
+
+                    st.success(
+                    f"✅ Sent: {final_filename} → {selected_sender['label']}"
+                    )
+
+            except Exception as e:
+                st.error(f"❌ Error ({current_file}): {str(e)}")
+
+            finally:
+                if pool is not None:
+                    # After a failure, queued files would otherwise still be
+                    # parsed and uploaded without ever being sent
+                    pool.shutdown(wait=False, cancel_futures=True)
+                if parse_pool is not None:
+                    parse_pool.shutdown(wait=False, cancel_futures=True)
+
+    st.markdown("---")
+    st.markdown("Built with Streamlit • Powered by WasenderAPI")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+import csv
+import datetime
+import functools
+import io
+import itertools
+import re
+import unicodedata
+
+import numpy as np
+import pandas as pd
+from python_calamine import CalamineWorkbook
+
+# Parsing and filtering live outside app.py so worker processes can import
+# them without re-running the Streamlit script.
+
+# =========================
+# Helpers
+# =========================
+_RE_START = re.compile(r"^[A-Za-z0-9]")
+_RE_SEP = re.compile(r"[\s._\-]+")
+_RE_BAD = re.compile(r"[^a-z0-9 ]+")
+
+# ASCII fast path for the two regexes above: separators become spaces,
+# every other non-alphanumeric character is dropped
+_TRANS = str.maketrans({
+    chr(i): " " if chr(i).isspace() or chr(i) in "._-" else None
+    for i in range(128)
+    if not chr(i).isalnum()
+})
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def norm(s: str) -> str:
+    s = str(s or "")
+
+    # ASCII is already NFKC, and most non-ASCII text is too
+    if not s.isascii() and not unicodedata.is_normalized("NFKC", s):
+        s = unicodedata.normalize("NFKC", s)
+
+    s = s.strip()
+    if not s:
+        return ""
+
+    # Exclude columns starting with special chars
+    if not _RE_START.match(s):
+        return ""
+
+    s = s.lower()
+    if s.isascii():
+        s = s.translate(_TRANS)
+    else:
+        s = _RE_BAD.sub("", _RE_SEP.sub(" ", s))
+
+    return " ".join(s.split())
+
+
+@functools.lru_cache(maxsize=16)
+def normalize_columns(cols: tuple[str, ...]) -> frozenset[str]:
+    # Kept here rather than in app.py: Streamlit re-executes the script on
+    # every rerun, which would throw away a cache defined there
+    return frozenset(norm(c) for c in cols)
+
+
+# =========================
+# Excel Processing
+# =========================
+def cell_str(v) -> str:
+    # Mirror pandas' read_excel(dtype=str): blanks -> "", 3.0 -> "3"
+    if v is None:
+        return ""
+    if isinstance(v, float) and v.is_integer():
+        return str(int(v))
+    if isinstance(v, datetime.date):
+        # pandas turns dates into Timestamps: "2024-01-02 00:00:00"
+        return str(pd.Timestamp(v))
+    return str(v)
+
+
+def iter_rows(bio: io.BytesIO, file_ext: str):
+    if file_ext == "csv":
+        return csv.reader(io.TextIOWrapper(bio, encoding="utf-8-sig", newline=""))
+
+    sheet = CalamineWorkbook.from_filelike(bio).get_sheet_by_index(0)
+    return sheet.iter_rows()
+
+
+def process_excel(file_bytes: bytes, wanted_norm: frozenset[str], file_ext: str) -> pd.DataFrame:
+    bio = io.BytesIO(file_bytes)
+    rows = iter_rows(bio, file_ext)
+
+    # Only the first 300 rows are kept around for the header search,
+    # the rest of the sheet is streamed straight into the kept columns
+    head = [[cell_str(v) for v in row] for row in itertools.islice(rows, 300)]
+
+    if not head:
+        raise ValueError("Could not find header row matching allow-list")
+
+    # Score every candidate row in one pass: norm() runs once per distinct
+    # cell value and the per-row match counts come from a boolean matrix
+    top = np.empty((len(head), max(len(r) for r in head)), dtype=object)
+    top.fill("")
+    for i, vals in enumerate(head):
+        top[i, : len(vals)] = vals
+
+    # factorize hashes instead of sorting, unlike np.unique on objects
+    codes, uniq = pd.factorize(top.ravel())
+    is_wanted = np.array([norm(v) in wanted_norm for v in uniq], dtype=bool)
+    hits = is_wanted[codes].reshape(top.shape)
+    best_idx = int(hits.sum(axis=1).argmax())
+
+    # Kept columns are tracked by position, reusing the header row's hits,
+    # so repeated header labels can't collide
+    header_vals = head[best_idx]
+    keep_idx = np.flatnonzero(hits[best_idx, : len(header_vals)]).tolist()
+
+    if not keep_idx:
+        raise ValueError("No matching columns found")
+
+    if file_ext == "csv":
+        # Second pass with the C parser: unused columns are skipped during
+        # tokenizing instead of becoming Python strings first. Parsing starts
+        # at the header row, so wider title rows above it can't exceed
+        # `names`. skiprows counts blank lines like csv.reader does, so
+        # blank lines can still be left out of the body.
+        width = max(len(r) for r in head[best_idx:])
+        body = pd.read_csv(
+            io.BytesIO(file_bytes),
+            header=None,
+            names=range(width),
+            usecols=keep_idx,
+            skiprows=best_idx,
+            na_filter=False,
+            dtype=str,
+        )
+        body = body.iloc[1:].reset_index(drop=True)
+    else:
+        columns = [[] for _ in keep_idx]
+        for row in itertools.chain(head[best_idx + 1 :], rows):
+            for col, i in zip(columns, keep_idx):
+                col.append(cell_str(row[i]) if i < len(row) else "")
+
+        body = pd.DataFrame(dict(enumerate(columns)))
+
+    body.columns = [header_vals[i] for i in keep_idx]
+    # Arrow-backed strings live in contiguous buffers instead of one
+    # Python object per cell
+    return body.astype("string[pyarrow]")
+
+
+def filter_to_xlsx(file_bytes: bytes, wanted_norm: tuple[str, ...], file_ext: str) -> bytes:
+    filtered_df = process_excel(file_bytes, frozenset(wanted_norm), file_ext)
+
+    output = io.BytesIO()
+    # Cells are already strings; keep them as text rather than letting
+    # xlsxwriter turn them into numbers or hyperlinks
+    with pd.ExcelWriter(
+        output,
+        engine="xlsxwriter",
+        engine_kwargs={"options": {"strings_to_numbers": False, "strings_to_urls": False}},
+    ) as writer:
+        filtered_df.to_excel(writer, index=False)
+    return output.getvalue()
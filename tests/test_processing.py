@@ -0,0 +1,21 @@
+from processing import normalize_columns, process_excel
+
+WANTED = normalize_columns(("Sr No", "Item", "Gross Wt"))
+
+
+def read_csv_text(text: str):
+    return process_excel(text.encode(), WANTED, "csv")
+
+
+def test_csv_title_row_wider_than_header():
+    df = read_csv_text("Company: ABC,,,,,,\nSr No,Item,Gross Wt,Date\n1,Ring,2.5,2024-01-02\n")
+
+    assert list(df.columns) == ["Sr No", "Item", "Gross Wt"]
+    assert df.values.tolist() == [["1", "Ring", "2.5"]]
+
+
+def test_csv_blank_lines_are_skipped():
+    df = read_csv_text("\nReport\n\nSr No,Item,Gross Wt\n1,Ring,2.5\n\n   \n2,Chain,4\n")
+
+    assert list(df.columns) == ["Sr No", "Item", "Gross Wt"]
+    assert df.values.tolist() == [["1", "Ring", "2.5"], ["2", "Chain", "4"]]